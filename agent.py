@@ -4,13 +4,27 @@
 Agent léger : collecte métriques et POST JSON vers API distante.
 Config via /etc/sylon/config.yaml
 """
-import time, os, sys, socket, uuid, random, json, logging
-from datetime import datetime
+import time, os, sys, socket, uuid, random, json, logging, signal, select, tempfile
 import psutil
 import requests
+from requests.adapters import HTTPAdapter
 import yaml
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+try:
+    import orjson
+    _dumps = orjson.dumps
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
 
 # Logging
+# pas de thread/process/fichier source dans le format : inutile de les collecter par record
+logging.logThreads = False
+logging.logProcesses = False
+logging._srcfile = None
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 logger = logging.getLogger("sylon-agent")
 
@@ -25,44 +39,155 @@ DEFAULT_CONFIG = {
     "jitter": 0.3
 }
 
+# Plafond de l'intervalle entre ticks quand l'envoi échoue en boucle
+# (jamais en dessous de interval_seconds) et de l'exposant du backoff
+MAX_BACKOFF_SECONDS = 3600
+MAX_BACKOFF_EXPONENT = 10
+
+def _tick_interval(interval, failures):
+    # endpoint en échec : on espace les ticks (plafond 1h, ou interval s'il est plus long)
+    if not failures:
+        return interval
+    backoff = interval * 2 ** min(failures, MAX_BACKOFF_EXPONENT)
+    return min(backoff, max(interval, MAX_BACKOFF_SECONDS))
+
+# HTTP session : keep-alive + pool de connexions, évite un handshake TCP/TLS par envoi
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=0)
+_SESSION.mount("http://", _ADAPTER)
+_SESSION.mount("https://", _ADAPTER)
+_SESSION.headers.update({"Content-Type": "application/json"})
+
+# Cache de la config parsée, invalidé sur changement du fichier
+# (mtime en ns + taille + inode : une mtime grossière seule peut rater une édition)
+_CFG_CACHE = {"path": None, "key": None, "cfg": None}
+
 def load_config(path="/etc/sylon/config.yaml"):
-    if os.path.exists(path):
-        with open(path) as f:
-            cfg = yaml.safe_load(f)
-            if not cfg: return DEFAULT_CONFIG
-            DEFAULT_CONFIG.update(cfg)
-            return DEFAULT_CONFIG
-    else:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
         logger.warning("Config file not found, using defaults")
-        return DEFAULT_CONFIG
+        return DEFAULT_CONFIG.copy()
+    key = (st.st_mtime_ns, st.st_size, st.st_ino)
+    if _CFG_CACHE["path"] == path and _CFG_CACHE["key"] == key:
+        # copie : un appelant qui modifie son dict ne doit pas corrompre le cache
+        return dict(_CFG_CACHE["cfg"])
+    with open(path) as f:
+        local_cfg = yaml.load(f, Loader=_Loader)
+    if local_cfg is not None and not isinstance(local_cfg, dict):
+        raise ValueError(f"{path}: expected a mapping, got {type(local_cfg).__name__}")
+    cfg = DEFAULT_CONFIG.copy()
+    if local_cfg:
+        cfg.update(local_cfg)
+    _CFG_CACHE.update(path=path, key=key, cfg=cfg)
+    return dict(cfg)
+
+# Champs invariants sur la durée de vie du process, calculés une seule fois
+_STATIC = None
+
+def _static_metrics():
+    global _STATIC
+    if _STATIC is None:
+        uname = os.uname()
+        _STATIC = {
+            "hostname": socket.gethostname(),
+            "machine_id": get_machine_id(),
+            "platform": {
+                "system": uname.sysname,
+                "release": uname.release,
+                "version": uname.version
+            },
+            "cpu_count_logical": psutil.cpu_count(logical=True),
+            "cpu_count_physical": psutil.cpu_count(logical=False),
+            "boot_time": psutil.boot_time()
+        }
+    return _STATIC
+
+# cpu_percent(interval=None) mesure depuis l'appel précédent ; en dessous de ce délai
+# (premier tick) la valeur n'a pas de sens, on bloque brièvement à la place
+_CPU_MIN_SAMPLE = 0.1
+_cpu_sampled_at = None
+
+def _cpu_percent():
+    global _cpu_sampled_at
+    if _cpu_sampled_at is None or time.monotonic() - _cpu_sampled_at < _CPU_MIN_SAMPLE:
+        value = psutil.cpu_percent(interval=_CPU_MIN_SAMPLE)
+    else:
+        value = psutil.cpu_percent(interval=None)
+    _cpu_sampled_at = time.monotonic()
+    return value
+
+# Sous Linux on lit /proc et statvfs directement (mêmes calculs que psutil),
+# sans passer par les objets psutil ; psutil reste le fallback ailleurs
+_LINUX = sys.platform.startswith("linux")
+
+def _memory():
+    if _LINUX:
+        try:
+            fields = {}
+            with open("/proc/meminfo", "rb") as f:
+                for line in f:
+                    key, _, rest = line.partition(b":")
+                    if key in (b"MemTotal", b"MemAvailable"):
+                        fields[key] = int(rest.split()[0]) * 1024
+                        if len(fields) == 2:
+                            break
+            total, available = fields[b"MemTotal"], fields[b"MemAvailable"]
+            percent = round((total - available) / total * 100, 1) if total else 0.0
+            return {"total": total, "available": available, "percent": percent}
+        except (OSError, KeyError, ValueError, IndexError):
+            pass
+    vm = psutil.virtual_memory()
+    return {"total": vm.total, "available": vm.available, "percent": vm.percent}
+
+def _disk(path):
+    if _LINUX:
+        try:
+            st = os.statvfs(path)
+        except OSError:
+            pass
+        else:
+            total = st.f_blocks * st.f_frsize
+            free = st.f_bavail * st.f_frsize
+            used = (st.f_blocks - st.f_bfree) * st.f_frsize
+            percent = round(used / (used + free) * 100, 1) if used + free else 0.0
+            return {"total": total, "used": used, "free": free, "percent": percent}
+    du = psutil.disk_usage(path)
+    return {"total": du.total, "used": du.used, "free": du.free, "percent": du.percent}
 
 def collect_metrics():
+    static = _static_metrics()
     data = {}
-    data["timestamp"] = datetime.utcnow().isoformat() + "Z"
-    data["hostname"] = socket.gethostname()
-    data["machine_id"] = get_machine_id()
-    data["platform"] = {
-        "system": os.uname().sysname,
-        "release": os.uname().release,
-        "version": os.uname().version
-    }
-    # CPU
-    data["cpu_percent"] = psutil.cpu_percent(interval=1)
-    data["cpu_count_logical"] = psutil.cpu_count(logical=True)
-    data["cpu_count_physical"] = psutil.cpu_count(logical=False)
+    data["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())  # ISO 8601 UTC, comme api.js
+    data["hostname"] = static["hostname"]
+    data["machine_id"] = static["machine_id"]
+    data["platform"] = dict(static["platform"])
+    # CPU (non bloquant : % depuis le tick précédent)
+    data["cpu_percent"] = _cpu_percent()
+    data["cpu_count_logical"] = static["cpu_count_logical"]
+    data["cpu_count_physical"] = static["cpu_count_physical"]
     # Memory
-    vm = psutil.virtual_memory()
-    data["memory"] = {"total": vm.total, "available": vm.available, "percent": vm.percent}
+    data["memory"] = _memory()
     # Disk
-    du = psutil.disk_usage("/")
-    data["disk"] = {"total": du.total, "used": du.used, "free": du.free, "percent": du.percent}
+    data["disk"] = _disk("/")
     # Load, uptime, net
     try:
         load1, load5, load15 = os.getloadavg()
         data["loadavg"] = {"1": load1, "5": load5, "15": load15}
     except Exception:
         data["loadavg"] = {}
-    data["uptime_seconds"] = int(time.time() - psutil.boot_time())
+    data["uptime_seconds"] = int(time.time() - static["boot_time"])
+    data["ipv4"] = get_primary_ipv4()
+    return data
+
+# L'IPv4 principale change rarement : on évite d'énumérer les NICs à chaque tick
+_IPV4_CACHE = {"ts": 0, "val": None}
+_IPV4_TTL = 60
+
+def get_primary_ipv4():
+    now = time.monotonic()
+    if _IPV4_CACHE["ts"] and now - _IPV4_CACHE["ts"] < _IPV4_TTL:
+        return _IPV4_CACHE["val"]
     net = psutil.net_if_addrs()
     # pick first non-loopback IPv4
     ipv4 = None
@@ -72,52 +197,79 @@ def collect_metrics():
                 ipv4 = a.address
                 break
         if ipv4: break
-    data["ipv4"] = ipv4
-    return data
+    _IPV4_CACHE.update(ts=now, val=ipv4)
+    return ipv4
+
+_MACHINE_ID = None
 
 def get_machine_id():
+    # Invariant pour la durée de vie du process : lu une seule fois
+    global _MACHINE_ID
+    if _MACHINE_ID is None:
+        _MACHINE_ID = _read_machine_id()
+    return _MACHINE_ID
+
+def _read_machine_id():
     # Prefer stable host id; fallback to uuid file
-    try:
-        # systemd-machine-id exists on many distros
-        for path in ("/etc/machine-id", "/var/lib/dbus/machine-id"):
-            if os.path.exists(path):
-                with open(path) as f:
-                    return f.read().strip()
-    except Exception:
-        pass
+    # systemd-machine-id exists on many distros
+    for path in ("/etc/machine-id", "/var/lib/dbus/machine-id"):
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except Exception:
+            pass
     # fallback to generated uuid persisted
     path = "/var/lib/sylon/id"
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    except Exception:
+        return str(uuid.getnode())
     try:
         os.makedirs(os.path.dirname(path), exist_ok=True)
-        if os.path.exists(path):
-            with open(path) as f:
-                return f.read().strip()
         mid = str(uuid.uuid4())
-        with open(path, "w") as f:
-            f.write(mid)
+        # écriture atomique : un crash en cours d'écriture ne laisse pas d'id tronqué
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".id.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(mid)
+                f.flush()
+                os.fchmod(f.fileno(), 0o644)
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except Exception:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
         return mid
     except Exception:
         return str(uuid.getnode())
 
+def configure_session(cfg):
+    # En-têtes invariants posés une fois sur la session plutôt qu'à chaque envoi
+    _SESSION.headers["Authorization"] = f"Bearer {cfg['api_key']}"
+
 def send_payload(cfg, payload):
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {cfg['api_key']}"
-    }
     url = cfg["endpoint"]
     max_retries = cfg.get("max_retries", 5)
     base = cfg.get("backoff_base", 2)
     jitter = cfg.get("jitter", 0.3)
     timeout = cfg.get("timeout_seconds", 10)
+    body = _dumps(payload)
 
     for attempt in range(1, max_retries+1):
         try:
-            r = requests.post(url, json=payload, headers=headers, timeout=timeout)
+            r = _SESSION.post(url, data=body, timeout=timeout)
             if r.status_code in (200,201,202):
                 logger.info("Payload accepted (status=%s)", r.status_code)
                 return True
             elif 400 <= r.status_code < 500:
-                logger.error("Client error sending payload: %s %s", r.status_code, r.text)
+                if logger.isEnabledFor(logging.ERROR):
+                    logger.error("Client error sending payload: %s %s", r.status_code, r.text[:512])
                 return False
             else:
                 logger.warning("Server error %s; attempt %s/%s", r.status_code, attempt, max_retries)
@@ -125,25 +277,105 @@ def send_payload(cfg, payload):
             logger.warning("Request failed attempt %s/%s: %s", attempt, max_retries, e)
         # backoff with jitter
         sleep = (base ** attempt) + random.uniform(0, jitter)
-        time.sleep(min(sleep, 60))
+        _wait_until(time.monotonic() + min(sleep, 60))
+        if _SIGNALS["stop"]:
+            return False
     logger.error("All retries failed")
     return False
 
+# Arrêt (SIGTERM/SIGINT) et rechargement de config (SIGHUP) sans attendre la fin du sleep.
+# Le handler ne fait que lever des drapeaux ; le réveil passe par set_wakeup_fd (écrit
+# par l'interpréteur au niveau C) et un select sur le pipe, sans verrou côté handler.
+_SIGNALS = {"stop": False, "reload": False}
+_WAKE_FD = None
+
+def _handle_signal(signum, frame):
+    if signum == signal.SIGHUP:
+        _SIGNALS["reload"] = True
+    else:
+        _SIGNALS["stop"] = True
+
+def _install_signal_handlers():
+    global _WAKE_FD
+    r, w = os.pipe()
+    os.set_blocking(r, False)
+    os.set_blocking(w, False)
+    signal.set_wakeup_fd(w, warn_on_full_buffer=False)
+    _WAKE_FD = r
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(sig, _handle_signal)
+
+def _wait_until(deadline, wake_on_reload=False):
+    # Dort jusqu'à deadline (time.monotonic) ; rend la main plus tôt sur arrêt,
+    # ou sur SIGHUP si wake_on_reload
+    while not _SIGNALS["stop"] and not (wake_on_reload and _SIGNALS["reload"]):
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            return
+        if _WAKE_FD is None:
+            time.sleep(timeout)
+            continue
+        ready, _, _ = select.select([_WAKE_FD], [], [], timeout)
+        if ready:
+            try:
+                os.read(_WAKE_FD, 512)
+            except BlockingIOError:
+                pass
+
 def main():
+    _install_signal_handlers()
     cfg = load_config()
     interval = int(cfg.get("interval_seconds", 300))
+    configure_session(cfg)
     logger.info("Starting agent; sending to %s every %s seconds", cfg["endpoint"], interval)
-    while True:
+    _static_metrics()
+    consecutive_failures = 0
+    while not _SIGNALS["stop"]:
+        # None : exception locale (collecte...), ne compte pas comme un échec d'envoi
+        sent = None
         try:
             payload = collect_metrics()
-            send_payload(cfg, payload)
+            sent = send_payload(cfg, payload)
         except Exception as e:
             logger.exception("Unexpected error in main loop: %s", e)
-        time.sleep(interval)
+        if _SIGNALS["stop"]:
+            break
+        if sent:
+            consecutive_failures = 0
+        elif sent is False:
+            consecutive_failures += 1
+        backing_off = sent is False
+        effective_interval = _tick_interval(interval, consecutive_failures if backing_off else 0)
+        if backing_off:
+            logger.warning("Send failed %s time(s) in a row; next attempt in %s seconds",
+                           consecutive_failures, effective_interval)
+        wait_started = time.monotonic()
+        next_tick_at = wait_started + effective_interval
+        while True:
+            _wait_until(next_tick_at, wake_on_reload=True)
+            if not _SIGNALS["reload"] or _SIGNALS["stop"]:
+                break
+            _SIGNALS["reload"] = False
+            # une config invalide ne doit pas tuer l'agent : on garde la config courante
+            try:
+                new_cfg = load_config()
+                new_interval = int(new_cfg.get("interval_seconds", 300))
+            except Exception as e:
+                logger.error("Config reload failed, keeping current config: %s", e)
+                continue
+            target_changed = (new_cfg["endpoint"], new_cfg["api_key"]) != (cfg["endpoint"], cfg["api_key"])
+            cfg, interval = new_cfg, new_interval
+            configure_session(cfg)
+            logger.info("Config reloaded; sending to %s every %s seconds", cfg["endpoint"], interval)
+            # la nouvelle config s'applique tout de suite : endpoint/clé corrigés => envoi
+            # immédiat, sinon prochain tick recalculé depuis le début de l'attente
+            if target_changed:
+                consecutive_failures = 0
+                next_tick_at = time.monotonic()
+            else:
+                failures = consecutive_failures if backing_off else 0
+                next_tick_at = wait_started + _tick_interval(interval, failures)
+    logger.info("Shutting down")
 
 if __name__ == "__main__":
-    try:
-        main()
-    except KeyboardInterrupt:
-        logger.info("Shutting down")
-        sys.exit(0)
\ No newline at end of file
+    main()
\ No newline at end of file